@@ -1,12 +1,15 @@
 #!/usr/bin/python3
-import os, re, shutil
-import psutil, pprint, shelve
-import itertools
-from math import log2
+import argparse, functools, os, re, shutil, subprocess
+import pprint, sqlite3
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
 
 # utilizing rich for prettier text output
 from rich import print
 from rich.console import Console
+from rich.table import Table
 import logging
 from rich.logging import RichHandler
 console = Console()
@@ -17,6 +20,19 @@ logging.basicConfig(
     level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
 )
 
+DB_DIRS = 'dirs.sqlite'
+# bump whenever what's stored in the dircache table changes meaning, so that old
+# entries get thrown away rather than mixed in with new ones.  see open_db()
+DIRCACHE_VERSION = 1
+
+# unraid array disks are mounted as /mnt/disk1, /mnt/disk2 ...
+DISK_PATTERN = re.compile(r"^disk[0-9]+$")
+# a top level directory on a disk:  /mnt/[disk_name]/[share_name]/[directory]
+SHARE_PATTERN = re.compile(r"^/mnt/(?P<disk>[^/]+)/(?P<share>[^/]+)/(?P<dir>.+)$")
+
+# move planning works in whole gigabytes.  see pick_dirs()
+GB = 1 << 30
+
 
 """
 Hopefully, eventually, this will be a tool I can use to balance unraid shares. The idea
@@ -26,24 +42,37 @@ utility to do said balancing.
 """
 
 ### start functions
+def scan_dirs(path):
+    """
+    the subdirectories of path, as DirEntry objects.  is_dir(follow_symlinks=False)
+    is answered from the file type that came back with the directory listing, so
+    nothing here needs a stat() of its own.  symlinks are skipped.
+    """
+    with os.scandir(path) as p:
+        return [entry for entry in p if entry.is_dir(follow_symlinks=False)]
+
 def find_disks(depth):
     """
     which disks are available to unraid.  to start, this is going to be janky and simply use /mnt/ with a max depth of 1, and match disk*
+
+    depth works the same as in get_shares: depth 2 only looks at the entries directly
+    under /mnt.  anything deeper is walked breadth first off a queue rather than by
+    recursing, and there's no reason to look inside a disk once it's been found.
     """
     rootdir = "/mnt"
     disks = []
-    pattern = "(disk[0-9])"
-    with os.scandir(rootdir) as p:
-        depth -= 1
-        for entry in p:
+    pending = deque([(rootdir, depth - 1)])
+    while pending:
+        dirpath, depth = pending.popleft()
+        if depth <= 0:
+            continue
+        for entry in scan_dirs(dirpath):
             #yield entry.path
-            if entry.is_dir() and depth > 0:
-                diskmatch = re.search(pattern, str(entry))
-                if diskmatch:
-                    # <DirEntry 'disk8'>
-                    # extract disk name from string similar to above utilizing the grouping from pattern string
-                    disk_name = str(diskmatch.group(1))
-                    disks.append(disk_name)
+            # entry.name is the bare directory name, eg: 'disk8'
+            if DISK_PATTERN.match(entry.name):
+                disks.append(entry.name)
+            elif depth > 1:
+                pending.append((entry.path, depth - 1))
     disks.sort()
     return(disks)
 
@@ -53,86 +82,156 @@ def get_shares(depth):
     """
     rootdir = "/mnt/user0/"
     shares = []
-    pattern = "('\w+')"
-    with os.scandir(rootdir) as p:
-        depth -= 1
-        for entry in p:
-            #yield entry.path
-            if entry.is_dir() and depth > 0:
-                sharematch = re.search(pattern, str(entry))
-                if sharematch:
-                    # extract share name utilizing the grouping regex and remove single quotes
-                    share_name = sharematch.group(1)
-                    share_name = str(share_name.replace("'",""))
-                    shares.append(share_name)
+    depth -= 1
+    if depth > 0:
+        shares = [entry.name for entry in scan_dirs(rootdir)]
     shares.sort()
     return(shares)
 
-def get_dirs(basedir):
+def get_dirs(basedir, cache):
     """
-    build a list of all subdirectories in all shares, with a depth limit of 1
-
-    depth is a method to limit how far down the directory structure the code will look.
-    I'm only interested in 1 level after the share name:
+    build a list of all subdirectories in a share, one level deep:
         /mnt/disk1/movies/this_directory_is_calculated
 
-    since dirname will be /mnt/[disk_name]/[share_name] I only want to go one level
-    deeper.  set depth as 2, and the first iteration will lower it to 1, and the code
-    will stop once depth is not > 0.
+    basedir is /mnt/[disk_name]/[share_name].  the listing goes through read_dir(), so
+    a share that hasn't had anything added or removed at the top since the last run
+    costs a single stat() rather than a scandir().
 
-    os.scandir() will encapsulate the directory name in single quotes
-      -- just kidding.  if there is a single quote in the directory name, it will be
-     encapsulated in double quotes.
+    returns the directories along with a new dircache row for basedir (None if the
+    cached listing was used), for the caller to write back.
     """
-    pattern = "['|\"](.*)['|\"]"
-    depth = 3
     # does the directory exist?
-    isDirectory = os.path.isdir(dirname)
-    if isDirectory:
-        with os.scandir(dirname) as p:
-            depth -= 1
+    isDirectory = os.path.isdir(basedir)
+    if not isDirectory:
+        return [], None
+    filebytes, dirs, row = read_dir(basedir, cache)
+    return dirs, row
+
+def open_db():
+    """
+    everything that's kept between runs lives in one sqlite file, as plain integer
+    and text columns:
+        dirs      the size of every top level directory, from the last scan
+        dircache  per-directory entries for read_dir().  subdirs is the list of
+                  subdirectory paths joined with NUL, which can't appear in a path
+
+    the file is in WAL mode, so the many small commits made during a scan are cheap
+    and anything committed survives the scan being interrupted.  the file's
+    user_version records which DIRCACHE_VERSION the cache was built with.
+    """
+    conn = sqlite3.connect(DB_DIRS)
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != DIRCACHE_VERSION:
+        conn.execute("DROP TABLE IF EXISTS dircache")
+        conn.execute("PRAGMA user_version = %d" % DIRCACHE_VERSION)
+    conn.execute("CREATE TABLE IF NOT EXISTS dirs(path TEXT PRIMARY KEY, size INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS dircache(path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                 "ino INTEGER, filebytes INTEGER, subdirs TEXT)")
+    return conn
+
+def load_dircache(conn):
+    """
+    read the whole per-directory cache into a dict with a single query:
+        path -> (mtime_ns, ino, filebytes, subdirs)
+    one pass over the table is far cheaper than a lookup per directory, and the scan
+    threads can all read the one dict without needing their own connections.
+    """
+    return {row[0]: row[1:] for row in conn.execute("SELECT path, mtime_ns, ino, filebytes, subdirs FROM dircache")}
+
+def read_dir(dirpath, cache):
+    """
+    the disk space taken up by dirpath itself and the files directly inside it, and
+    the full paths of its subdirectories (symlinks aren't followed).
+
+    space is counted as allocated blocks (st_blocks * 512) rather than st_size, since
+    that's what actually shows up in a disk's used space.  unlike du, a hardlinked
+    file is counted once for every link to it, so trees with hardlinks come out
+    bigger than du -s says.  (rsync_move doesn't pass -H either, so each link really
+    does land on the target as its own copy.)
+
+    files that disappear between the listing and the stat() are skipped, and so is a
+    directory that disappears or can't be read (with a warning).
+
+    both are cached in dircache (see load_dircache), keyed by path and validated
+    against the directory's mtime and inode.  adding, removing or renaming anything in
+    a directory bumps its mtime, so an unchanged directory only costs a single stat()
+    instead of a stat() per file.
+      caveat: a file that grows or is rewritten in place doesn't touch its
+      directory's mtime, so its cached size goes stale.  run with --rescan to
+      throw the cache away and rebuild every entry.
+
+    returns filebytes, subdirs and the new dircache row, or None for the row when
+    the cached entry was still good.
+    """
+    try:
+        st = os.stat(dirpath, follow_symlinks=False)
+        cached = cache.get(dirpath)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_ino:
+            subdirs = cached[3].split("\0") if cached[3] else []
+            return cached[2], subdirs, None
+        filebytes = st.st_blocks * 512
+        subdirs = []
+        with os.scandir(dirpath) as p:
             for entry in p:
-                # no symlinks
-                if not os.path.islink(entry):
-                    if entry.is_dir() and depth > 0:
-                        dirmatch = re.search(pattern, str(entry))
-                        if dirmatch:
-                            # extract directory name utilizing the grouping regex
-                            matched_dir = dirmatch.group(1)
-                            full_dir_name = dirname + "/" + matched_dir
-
-                            # append directory to dirlist
-                            dirlist.append(full_dir_name)
-
-                            # populate dirstats dictionary with directory size information
-                            dirsize = get_tree_size(full_dir_name)
-                            dirstats[full_dir_name] = dirsize
-
-def get_tree_size(path):
-    # total size of files in given path and subdirs.
-    total = 0
-    for entry in os.scandir(path):
-        if entry.is_dir(follow_symlinks=False):
-            total += get_tree_size(entry.path)
-        else :
-            total += entry.stat(follow_symlinks=False).st_size
-    return total
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    try:
+                        filebytes += entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        continue
+    except OSError as error:
+        # the directory went away mid-scan (normal on a live array) or can't be
+        # read.  count it as empty rather than losing the whole scan over it
+        log.warning("skipping %s: %s" % (dirpath, error))
+        return 0, [], None
+    return filebytes, subdirs, (dirpath, st.st_mtime_ns, st.st_ino, filebytes, "\0".join(subdirs))
+
+def get_tree_size(path, cache):
+    """
+    total size of files in given path and subdirs.
 
+    each directory is read through read_dir() against cache, the dict from
+    load_dircache(), so unchanged directories come straight out of it.  the subtree
+    total is always re-summed from the per-directory values, so a change anywhere
+    below is still picked up by every parent.
 
-def disk_used(disk):
-    mount = "/mnt/" + disk
-    usage = psutil.disk_usage(mount)
-    used = usage.used
-    diskstats[disk] = used
+    returns the total along with any new/changed dircache rows, for the caller to
+    write back, and every directory that was read, so the caller can tell which
+    dircache rows are still in use.
+    """
+    total = 0
+    fresh = []
+    seen = []
+    pending = [path]
+    while pending:
+        dirpath = pending.pop()
+        seen.append(dirpath)
+        filebytes, subdirs, row = read_dir(dirpath, cache)
+        if row:
+            fresh.append(row)
+        total += filebytes
+        pending.extend(subdirs)
+    return total, fresh, seen
+
+
+def used_bytes(path):
+    # same number psutil.disk_usage().used reports, straight from a single statvfs()
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+def disk_used(disks):
+    """
+    populate diskstats with the bytes used on every disk.  statvfs() on a spun down
+    disk waits for it to spin up, so ask all of them at once rather than waiting on
+    each in turn.  (the GIL is released for the syscall, so threads are enough)
+    """
+    with ThreadPoolExecutor(max_workers=len(disks) or 1) as ex:
+        diskstats.update(zip(disks, ex.map(used_bytes, ["/mnt/" + disk for disk in disks])))
 
 def average_disk(diskstats):
     # input should be the diskstats dictionary
-    count = 0
-    totalused = 0
-    for disk, used in diskstats.items():
-        count += 1
-        totalused += used
-    avgused = int(totalused/count)
+    avgused = sum(diskstats.values()) // len(diskstats)
     return(avgused)
 
 def disk_distance(avg):
@@ -141,245 +240,406 @@ def disk_distance(avg):
     example:  average usage is 2.5TB, and a disk has 4TB stored.  the distance is -1.5TB
     a negative distance indicates data needs to move off of the drive to bring it closer
     to the target average
+
+    only the byte count is stored.  formatting it for humans (datasize) is left to
+    wherever it actually gets displayed.
     """
     for disk, used in diskstats.items():
-        diskdistance[disk] = {}
+        # a disk sitting exactly on the average neither gives nor takes
+        diskdistance[disk] = {'diff': 0, 'mover': None}
         #print(type(disk))
         #print("disk: " + disk)
         #print("used: " + str(used))
         if avg > used:
             diff = int(avg - used)
-            hdiff = str(datasize(diff))
-            diskdistance[disk] = {'diff': diff, 'mover': 'target', 'hdiff': hdiff}
+            diskdistance[disk] = {'diff': diff, 'mover': 'target'}
         if used > avg:
             diff = -1*(int(used - avg))
-            hdiff = datasize(abs(diff))
-            hdiff = "-" + str(hdiff)
-            diskdistance[disk] = {'diff': diff, 'mover': 'source', 'hdiff': hdiff}
+            diskdistance[disk] = {'diff': diff, 'mover': 'source'}
 
+@functools.lru_cache(maxsize=4096)
 def datasize(num):
     # "human readable" formatting
-    step_unit = 1024.0
-
-    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
-        if num < step_unit:
-            return "%3.1f %s" % (num, x)
-        num /= step_unit
+    # the same few disk totals get formatted over and over for every summary table,
+    # so the results are cached
+    # each unit is another 10 bits, so the bit length picks the unit directly and
+    # there's only the one division, at the end
+    units = ('bytes', 'KB', 'MB', 'GB', 'TB', 'PB')
+    idx = min(max(int(num).bit_length() - 1, 0) // 10, len(units) - 1)
+    return "%3.1f %s" % (num / (1 << (idx * 10)), units[idx])
 
 
 
 def calculate_moves(diskdistance):
     """
-    start with smallest number (largest excess data) and largest number (needs most data)
-    find the difference of the pair, and then traverse diskdistance dictionary to find
-    the closest match in data volume to move from source to target.
+    plan every move for the array in one pass.  drives below the average are the
+    targets, drives above it are the sources.  take the target that needs the most
+    data and the source with the most to spare, and move the smaller of those two
+    amounts between them: either the target is now full, or the source has nothing
+    left to give, so one of them drops out.  that's at most one round per drive, each
+    of which is a single pick_dirs() call.
+
+    returns a list of (bytes moved, move_list, target, source)
+    """
+    # how much each drive still needs (targets) or has to spare (sources)
+    need = {disk: info['diff'] for disk, info in diskdistance.items() if info['diff'] > 0}
+    spare = {disk: -info['diff'] for disk, info in diskdistance.items() if info['diff'] < 0}
+    moves = []
+    while need and spare:
+        # maxdrive = needs most data, mindrive = needs to lose the most data
+        maxdrive = max(need, key=need.get)
+        mindrive = max(spare, key=spare.get)
+        # can mindrive supply enough data by itself to bring maxdrive to average,
+        # without falling below average itself?
+        target_full = spare[mindrive] >= need[maxdrive]
+        move_list = pick_dirs(disk_dirstats[mindrive], min(need[maxdrive], spare[mindrive]))
+        tuplesum = sum(move_list.values())
+        if move_list:
+            moves.append((tuplesum, move_list, maxdrive, mindrive))
+        need[maxdrive] -= tuplesum
+        spare[mindrive] -= tuplesum
+        if target_full:
+            del need[maxdrive]
+        else:
+            del spare[mindrive]
+        # pick_dirs can land a little over what was asked for, which can run the
+        # other drive of the pair past zero too.  it's done either way, and asking
+        # pick_dirs for a negative amount next round makes no sense
+        need = {disk: left for disk, left in need.items() if left > 0}
+        spare = {disk: left for disk, left in spare.items() if left > 0}
+    return moves
+
+def pick_dirs(scansizes, want):
+    """
+    choose the directories from scansizes, a drive's [(size, directory), ...] sorted
+    smallest to largest, whose sizes add up closest to want bytes.  keeping the path
+    with its size means two directories of the same size are both candidates.
+
+    returns a move_list of {directory: size}.  the chosen directories are removed from
+    scansizes so they can't be picked twice.
+
+    picking which directories to move is a subset-sum problem: out of all the
+    directory sizes on the source drive, find the combination whose total lands
+    closest to want.  trying itertools.combinations of every length blows up
+    exponentially once there are hundreds of directories, so instead:
+
+    round every size to whole gigabytes, and build up the set of every total
+    (up to the high tolerance) that some combination of directories can reach.
+    the set is kept as the bits of a single python int -- bit N set means N GB is
+    reachable -- so adding a directory of q GB is just reach | (reach << q), and
+    all of the work happens in C instead of a python loop over every total.
+    keeping the set as it was before each directory is enough to walk back and
+    recover the whole combination at the end: if the total wasn't reachable before
+    a directory was added, that directory is part of it.
+
+    each rounded size can be off by up to half a gigabyte, which adds up over a lot
+    of directories, so a total that looks right in gigabytes isn't trusted until the
+    actual bytes of its combination are checked against the tolerance too.  if they
+    miss, the next closest total gets a try.
     """
-    # maxdisk = needs most data, mindisk = needs to lose the most data
-    maxdisk = max(int(diff['diff']) for diff in diskdistance.values())
-    mindisk = min(int(diff['diff']) for diff in diskdistance.values())
-    #diskdiff = int((abs(mindisk) - maxdisk))
-    #print("max: %d | min: %d | diff: %d" % (maxdisk, abs(mindisk), diskdiff))
-
-    # perform this loop until mindisk and maxdisk are within 50gb.
-    # For the sake of this exercise, that will suffice as "balanced"
-    #while diskdiff > 53687063712:
-    scansizes = []
-    matched_dirs = {}
     move_list = {}
-    tuplesum = 0
-    # can mindisk supply enough data by itself to bring maxdisk to average,
-    # without falling below average itself:
-    if abs(mindisk) > maxdisk:
-        # yes?  then figure out what to move
-        # at this point, all we have is the bytecount for mindisk and maxdisk.
-        # determine which drives those belong to
-        for disk,info in diskdistance.items():
-            if info['diff'] == maxdisk:
-                maxdrive = disk
-            if info['diff'] == mindisk:
-                mindrive = disk
-        # find list of file sizes that reside on mindisk, and append to a list.
-        # also create a dictionary of matched directories and corresponding sizes
-        for filedir, dirsize in dirstats.items():
-            matchdir = re.search(mindrive, filedir)
-            if matchdir:
-                if dirsize == 0:
-                    continue
-                scansizes.append(dirsize)
-                matched_dirs[dirsize] = filedir
-        #sort the directory sizes largest to smallest.
-        scansizes.sort(reverse=True)
-
-        """
-        itertools.combinations will provide an exhaustive list of all possible
-        combinations.  When dealing with hundreds of different directory sizes, the
-        numbers start to get very large, very fast.
-          for example: with 400+ directories, even showing only 4 subsequences of
-          those 400+, I was in the tens of millions of combinations/calculations.
-          (take these 400+ numbers, and show me all the combinations of four of them)
-
-        to combat that, I have sorted the directory sizes in decending order.
-        that helps because we know the very first list of numbers returned from
-        itertools is going to be the first N numbers in the list, and thus will be
-        the highest possible combination of numbers at that subsequence check.  we
-        can skip literally billions of calculations by simply checking if those
-        first N numbers are larger than our target tolerance.  If they aren't, go to
-        the next iteration.
-        """
-        # maximum directory combinations to test.
-        max_dirs = 50
-
-        # tolerance is how close the total needs to be to the target in order
-        # to move forward.  between 90% and 105% of the target seems reasonable.
-        tolerance_low = int((.9 * maxdisk))
-        tolerance_high = int((1.05 * maxdisk))
-
-        counter = 0
-        for i in range(1,max_dirs):
-            # tt is a temp variable to store the first list of numbers returned.
-            tt = list(itertools.islice(itertools.combinations(scansizes,i), 1))
-
-            # since itertools returns a list of tuples, we have to first take the
-            # tuple out of a list, and then sum it.  probably cleaner ways to do this
-            for tuplemath in tt:
-                tuplesum = int(sum(list(tuplemath)))
-
-            # check tuplesum against our tolerance
-            if tuplesum < tolerance_low:
-                #print("%d: nope: %d vs low tolerance (%d)" % (i, tuplesum, tolerance_low))
-                continue
-            else:
-                # now we have a list of filesizes that match our minimum.
-                # check to make sure the list is within maximum tolerance
-                if tuplesum < tolerance_high:
-                    # earlier created matched_dirs will make it 'easy' to find the
-                    # directories that need moved.
-                    # first go through directory sizes from the list tuplemath above
-                    for dirsize in tuplemath:
-                        # search through matched_dirs for corresponding size, and
-                        # append to a new dictionary:  move_list
-                        for mdirsize,mdir in matched_dirs.items():
-                            if mdirsize == dirsize:
-                                #move_list.append(mdir)
-                                move_list[dirsize] = mdir
-                break
-        return tuplesum, move_list, maxdrive, mindrive
-        #diskdiff = 1
-
-def check_md5(source_dir, target_dir):
-    # traverse a directory of files
-
-
-def move_data(move_list, source, target):
-    # function to move the data (move_list) from source to target
+    if want <= 0:
+        return move_list
+    # tolerance is how close the total needs to be to the target in order
+    # to move forward.  between 90% and 105% of the target seems reasonable.
+    bytes_low = .9 * want
+    bytes_high = 1.05 * want
+    target = (want + GB // 2) // GB
+    tolerance_low = int((.9 * target))
+    tolerance_high = int((1.05 * target))
+
+    # since scansizes is sorted, the directories that round to 0GB (no help) or to
+    # more than tolerance_high (too big to ever fit) sit at either end of it.
+    # bisect for where the usable ones start and stop instead of testing each one.
+    # (size,) sorts before any (size, path), so these land on the first directory
+    # of the given size
+    first = bisect_left(scansizes, (GB // 2,))
+    last = bisect_left(scansizes, (tolerance_high * GB + GB // 2,))
+
+    # only 0 is reachable before any directories are added.  anything past
+    # tolerance_high is of no use, so mask it off as we go
+    reach = 1
+    mask = (1 << (tolerance_high + 1)) - 1
+    history = []
+    for i in range(first, last):
+        q = (scansizes[i][0] + GB // 2) // GB
+        history.append((i, q, reach))
+        reach = (reach | (reach << q)) & mask
+
+    candidates = [total for total in range(max(tolerance_low, 1), tolerance_high + 1) if reach >> total & 1]
+    for best in sorted(candidates, key=lambda total: abs(total - target)):
+        # walk back through history for the directories that make up this total
+        picked = []
+        for i, q, before in reversed(history):
+            if not before >> best & 1:
+                picked.append(i)
+                best -= q
+        if bytes_low <= sum(scansizes[i][0] for i in picked) <= bytes_high:
+            for i in picked:
+                dirsize, filedir = scansizes[i]
+                move_list[filedir] = dirsize
+                # it's spoken for now, so don't offer it up again.  picked runs
+                # backwards, so deleting doesn't shift any index still to come
+                del scansizes[i]
+            break
+    return move_list
+
+def rsync_move(source_dir, target_dir, execute=False):
+    """
+    move the contents of source_dir into target_dir with a single rsync.  unless
+    execute is set, this is only ever a dry run.
+
+    every move is a fresh copy onto a different disk, so rsync's delta-transfer has
+    nothing to work with and only costs time:  --whole-file skips the rolling
+    checksums, --inplace writes straight into the destination rather than a temp file
+    that then gets renamed, and there's no network for compression to help with.
+    (reflinks/hardlinks are out too, since source and target are separate filesystems)
+
+    there's no separate verify pass either.  rsync's own post-transfer checksum is the
+    verification: every file it sends is checked against a whole-file checksum before
+    --remove-source-files deletes the original.
+
+    several of these can run at once (see move_data), so rsync's output is captured
+    rather than left to fight over the terminal.  errors get logged with whatever rsync had to
+    say, and a successful move logs rsync's closing "sent ... speedup is" summary.
+    """
+    rsync_cmd = ["rsync", "-a", "--whole-file", "--inplace", "--no-compress", "--info=stats1"]
+    if execute:
+        rsync_cmd += ["--remove-source-files"]
+    else:
+        rsync_cmd += ["--dry-run"]
+    rsync_cmd += ["--", source_dir + "/", target_dir + "/"]
+    result = subprocess.run(rsync_cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        log.fatal("rsync exited with %d moving %s: %s" % (result.returncode, source_dir, result.stderr.strip()))
+        return False
+    summary = [line for line in result.stdout.splitlines() if line.startswith("sent ") or "speedup is" in line]
+    log.info("%s: %s" % (source_dir, " ".join(summary)))
+    if execute:
+        remove_empty_dirs(source_dir)
+    return True
+
+def remove_empty_dirs(path):
+    """
+    rsync --remove-source-files only removes files, so clear out the directory tree it
+    leaves behind, deepest first.  rmdir() refuses a directory that isn't empty, which
+    doubles as the emptiness check, so there's no need to list anything a second time.
+    anything rsync couldn't move stays put, along with the directories holding it.
+    """
+    for root, dirs, files in os.walk(path, topdown=False):
+        if files:
+            continue
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+    if os.path.lexists(path):
+        log.error("%s isn't empty after moving, leaving it in place" % path)
+
+def move_data(move_list, source, target, execute=False, jobs=1):
+    # function to move the data (move_list) from source to target.  only a dry run
+    # unless execute is set; see rsync_move().  up to jobs directories are moved at
+    # the same time
+
+    # target doesn't change from one directory to the next, so build its prefix
+    # once, up front
+    target_prefix = "/mnt/" + target + "/"
+
+    # (source_dir, target_dir, size) for every directory that's ready to go
+    transfers = []
 
     # iterate through move_list to find the share names.  we need to verify that
     # the source share /mnt/disk?/SHARE_NAME exists on the target
-    for size, source_dir in move_list.items():
+    for source_dir, size in move_list.items():
         # regex to match share name and directory to move
-        sharematch = re.search(r"\/mnt/" + source + "\/(.*)\/(.*)", source_dir)
-        if sharematch:
-            sharename = sharematch.group(1)
-            movedir = sharematch.group(2)
+        sharematch = SHARE_PATTERN.match(source_dir)
+        if sharematch and sharematch.group('disk') == source:
+            sharename = sharematch.group('share')
+            movedir = sharematch.group('dir')
             # test to see if directory exists on target
-            target_prefix = "/mnt/" + target + "/"
             target_share_dir = target_prefix + sharename
             target_dir = target_share_dir + "/" + movedir
-            if os.path.isdir(target_share_dir):
-                #print("source: %s | target: %s" % (source_dir, target_dir))
-                # the time has come to move some files.
-                # I've chosen to copy so that I can verify md5sums before deleting
-                print("copying %s to %s" % (source_dir, target_dir))
-                #shutil.copytree(source_dir, target_dir)
-                # verify files match
-                check_md5(source_dir, target_dir)
-                continue
-            else:
+            if not os.path.isdir(target_share_dir):
                 log.fatal("NOT FOUND: %s" % target_share_dir)
-                # target directory doesn't exist.  try to create it.
-                try:
-                    os.mkdir(target_share_dir)
-                    print("mv %s %s" % (source_dir, target_dir))
-                except OSError as error:
-                    log.fatal(error)
-                    break
+                # target directory doesn't exist.  try to create it, but only for
+                # real.  a dry run leaves the disk alone and lets rsync --dry-run
+                # report what it would have created
+                if execute:
+                    try:
+                        os.mkdir(target_share_dir)
+                    except OSError as error:
+                        log.fatal(error)
+                        break
+            #print("source: %s | target: %s" % (source_dir, target_dir))
+            transfers.append((source_dir, target_dir, size))
         else:
             # if we don't get a share match.  something is wrong, though I don't
             # really know what it would be.
             log.fatal("No share matched.  Something is fishy.")
             break
 
+    # the time has come to move some files.
+    # rsync only removes a source file once it has been copied over.  every directory
+    # here goes between the same two disks, so by default they're moved one after
+    # another:  several rsyncs at once only make both disks seek back and forth, and
+    # interleave the --inplace writes into fragments on the target.  jobs > 1 is
+    # there for anyone who wants to try it anyway
+    def transfer(move):
+        source_dir, target_dir, size = move
+        print("moving %s to %s" % (source_dir, target_dir))
+        return rsync_move(source_dir, target_dir, execute)
 
+    with ThreadPoolExecutor(max_workers=min(jobs, len(transfers)) or 1) as ex:
+        results = list(ex.map(transfer, transfers))
 
+    # the rows for the summary table, and the projected usage in diskstats_after.
+    # only directories that actually made it across count
+    rows = []
+    for (source_dir, target_dir, size), moved in zip(transfers, results):
+        if moved:
+            diskstats_after[source] -= size
+            diskstats_after[target] += size
+            rows.append((source_dir, target_dir, datasize(size)))
 
+    table = Table(title="%s -> %s" % (source, target))
+    table.add_column("source")
+    table.add_column("target")
+    table.add_column("size", justify="right")
+    for row in rows:
+        table.add_row(*row)
+    table.caption = "%s: %s -> %s | %s: %s -> %s" % (
+        source, datasize(diskstats[source]), datasize(diskstats_after[source]),
+        target, datasize(diskstats[target]), datasize(diskstats_after[target]))
+    print(table)
 
-### end functions
-
-# define lists/dictionaries that will be used
-disklist = []
-sharelist = []
-dirlist = []
-#dirstats = {}
-dirstats = shelve.open('dirs.db')
-#sharestats = {}
-#sharestats = shelve.open('shares.db')
-diskstats = {}
-diskdistance = {}
-movertype = []
-
-# find the disks and shares
-disklist = find_disks(2)
-sharelist = get_shares(2)
-
-# first populate sharestats{} with disk usage information, per-share.
-# then, find the top level directories for each share, on each disk
-for sharename in sharelist:
-    #    sharedir = "/mnt/user0/" + sharename
-    #    shareusage = get_tree_size(sharedir)
-    #    sharestats[sharedir] = shareusage
-    for diskname in disklist:
-        dirname = "/mnt/" + diskname + "/" + sharename
-        disk_used(diskname)
-        get_dirs(dirname)
 
 
 
-"""
-By the time the code gets here, we have established all of the data that we need to figure out what should be done.
-
-    * list of all physical drives (sketchy code, but it's functional)
-    * list of all shares on the array
-    * list of all top level directories in each share  (/mnt/disk?/$share_name/$TLD)
-    * disk usage for:
-        * every physical drive (free space and percent free)
-        * overall share disk usage
-        * every TLD under every share, on every drive
-"""
-
-# start with average size of data used.
-# this will be the approximate target for each drive.
-avg_disk_used = average_disk(diskstats)
-# calculate amount of data each drive needs to gain or lose to get close to the target
-disk_distance(avg_disk_used)
-movesum, movelist, maxdrive, mindrive = calculate_moves(diskdistance)
-move_data(movelist, mindrive, maxdrive)
 
-#print("Moving (%s): from %s to %s" % (datasize(movesum), mindrive, maxdrive))
-#print(movelist)
-#console.log("All local variables", log_locals=True)
-#pprint.pprint(movelist)
-#print("------- Disk Stats ----------")
-#pprint.pprint(diskstats)
-#print("------- Share Stats ----------")
-#pprint.pprint(sharestats)
-#print("------- Distance ----------")
-#pprint.pprint(diskdistance)
-#print("Avg: " + "| " + str(avg_disk_used) + " | " + str(datasize(avg_disk_used)))
-
-dirstats.close()
-#sharestats.close()
+### end functions
 
+# everything below only runs when called as a script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="balance data across unraid array disks")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="how many directories to rsync at the same time (default: 1)")
+    parser.add_argument("--rescan", action="store_true",
+                        help="throw away the directory cache and re-read every directory")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    # define lists/dictionaries that will be used
+    disklist = []
+    sharelist = []
+    dirlist = []
+    dirstats = {}
+    # the same sizes, split up by disk as [(size, directory), ...], smallest first
+    disk_dirstats = {}
+    #sharestats = {}
+    #sharestats = shelve.open('shares.db')
+    diskstats = {}
+    diskdistance = {}
+    movertype = []
+
+    # find the disks and shares
+    disklist = find_disks(2)
+    sharelist = get_shares(2)
+
+    # first populate diskstats{} with disk usage information, per-disk.
+    # then, find the top level directories for each share, on each disk.  unchanged
+    # share listings come straight out of the cache
+    disk_used(disklist)
+    db = open_db()
+    # --rescan throws the whole cache away, so every directory gets read again and
+    # dircache is rebuilt from scratch with fresh sizes
+    if args.rescan:
+        with db:
+            db.execute("DELETE FROM dircache")
+    dircache = load_dircache(db)
+    # every directory this run looks at.  anything in dircache that isn't in here
+    # by the end is gone (or moved off its disk) and gets dropped
+    visited = set()
+    share_rows = []
+    disk_dirs = {}
+    for diskname in disklist:
+        disk_dirs[diskname] = []
+        for sharename in sharelist:
+            #    sharedir = "/mnt/user0/" + sharename
+            #    shareusage = get_tree_size(sharedir)
+            #    sharestats[sharedir] = shareusage
+            dirname = "/mnt/" + diskname + "/" + sharename
+            dirs, row = get_dirs(dirname, dircache)
+            if os.path.isdir(dirname):
+                visited.add(dirname)
+            disk_dirs[diskname].extend(dirs)
+            if row:
+                share_rows.append(row)
+        dirlist.extend(disk_dirs[diskname])
+    with db:
+        db.executemany("INSERT OR REPLACE INTO dircache VALUES (?, ?, ?, ?, ?)", share_rows)
+
+    # size the directories, each top level directory as its own job.  the walk is
+    # nothing but scandir()/stat() calls, which let go of the GIL, so threads are
+    # enough, and a few per disk keeps every disk's queue busy.  jobs are interleaved
+    # across disks so they all get going at once rather than one after another.
+    # the workers only read the per-directory cache (see read_dir), and the main
+    # thread writes each directory's updates as soon as that directory is done.  if a
+    # long scan gets interrupted, everything that finished is already in the cache,
+    # so the next run only has to stat() its way back through it.
+    scan_order = [path for paths in zip_longest(*disk_dirs.values()) for path in paths if path]
+    with ThreadPoolExecutor(max_workers=len(disklist) * 4 or 1) as ex:
+        futures = {ex.submit(get_tree_size, path, dircache): path for path in scan_order}
+        for future in as_completed(futures):
+            size, fresh, seen = future.result()
+            dirstats[futures[future]] = size
+            visited.update(seen)
+            with db:
+                db.executemany("INSERT OR REPLACE INTO dircache VALUES (?, ?, ?, ?, ?)", fresh)
+    for diskname, dirs in disk_dirs.items():
+        disk_dirstats[diskname] = sorted((dirstats[path], path) for path in dirs)
+    with db:
+        db.execute("DELETE FROM dirs")
+        db.executemany("INSERT INTO dirs VALUES (?, ?)", dirstats.items())
+        db.executemany("DELETE FROM dircache WHERE path = ?",
+                       [(path,) for path in dircache.keys() - visited])
 
 
 
+    """
+    By the time the code gets here, we have established all of the data that we need to figure out what should be done.
+
+        * list of all physical drives (sketchy code, but it's functional)
+        * list of all shares on the array
+        * list of all top level directories in each share  (/mnt/disk?/$share_name/$TLD)
+        * disk usage for:
+            * every physical drive (free space and percent free)
+            * overall share disk usage
+            * every TLD under every share, on every drive
+    """
 
+    # start with average size of data used.
+    # this will be the approximate target for each drive.
+    avg_disk_used = average_disk(diskstats)
+    # calculate amount of data each drive needs to gain or lose to get close to the target
+    disk_distance(avg_disk_used)
+    # projected usage once the moves are done.  move_data() keeps it up to date as it
+    # goes, so each summary shows the running total across every move so far
+    diskstats_after = dict(diskstats)
+    for movesum, movelist, maxdrive, mindrive in calculate_moves(diskdistance):
+        move_data(movelist, mindrive, maxdrive, jobs=args.jobs)
+
+    #print("Moving (%s): from %s to %s" % (datasize(movesum), mindrive, maxdrive))
+    #print(movelist)
+    #console.log("All local variables", log_locals=True)
+    #pprint.pprint(movelist)
+    #print("------- Disk Stats ----------")
+    #pprint.pprint(diskstats)
+    #print("------- Share Stats ----------")
+    #pprint.pprint(sharestats)
+    #print("------- Distance ----------")
+    #pprint.pprint(diskdistance)
+    #print("Avg: " + "| " + str(avg_disk_used) + " | " + str(datasize(avg_disk_used)))
+
+    db.close()
+    #sharestats.close()